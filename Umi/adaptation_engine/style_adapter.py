@@ -2,14 +2,33 @@ import ast
 import json
 from telemetry_db import TelemetryDB
 from collections import defaultdict
+from typing import FrozenSet, List, Tuple
 import logging
 import re
 
 logging.basicConfig(filename='style_adapter.log', level=logging.INFO)
 
+_SNAKE_RE = re.compile(r'(?<!^)(?=[A-Z])')
+
+
+def _binding_shape(tree: ast.AST) -> Tuple[int, FrozenSet[str]]:
+    """(number of distinct bound names, free names); a consistent rename leaves both unchanged"""
+    bound, loaded = set(), set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            (loaded if isinstance(node.ctx, ast.Load) else bound).add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            bound.add(node.name)
+        elif isinstance(node, ast.arg):
+            bound.add(node.arg)
+    return len(bound), frozenset(loaded - bound)
+
+
 class StyleAdapter:
     def __init__(self, telemetry_db: TelemetryDB):
         self.db = telemetry_db
+        # suggestion_id format: "rule=brace_style:choice=next-line"
+        self._suggestion_re = re.compile(r"^rule=([^:]+):choice=([A-Za-z0-9_-]+)$")
         self.style_rules = self._load_base_rules()
         self.user_profile = self._build_initial_profile()
 
@@ -24,18 +43,18 @@ class StyleAdapter:
     def _build_initial_profile(self) -> dict:
         """Create style profile from telemetry acceptance patterns"""
         adaptation_data = self.db.get_adaptation_data()
+        # Bucket acceptance ratios by rule in one pass, then resolve each rule in O(1)
+        pref_scores = defaultdict(lambda: defaultdict(float))
+        for suggestion_id, accept_ratio in adaptation_data.items():
+            match = self._suggestion_re.match(suggestion_id)
+            if match:
+                rule_name, choice = match.groups()
+                pref_scores[rule_name][choice] = accept_ratio
         profile = {}
         for rule_name, rule_info in self.style_rules.items():
-            pref_scores = defaultdict(float)
-            for suggestion_id, accept_ratio in adaptation_data.items():
-                # Expect suggestion_id format: "rule=brace_style:choice=next-line"
-                if f"rule={rule_name}" in suggestion_id:
-                    match = re.search(r"choice=([A-Za-z0-9_-]+)", suggestion_id)
-                    if match:
-                        choice = match.group(1)
-                        pref_scores[choice] = accept_ratio
+            scores = pref_scores.get(rule_name)
             profile[rule_name] = (
-                max(pref_scores, key=pref_scores.get) if pref_scores else rule_info["default"]
+                max(scores.items(), key=lambda kv: kv[1])[0] if scores else rule_info["default"]
             )
         return profile
 
@@ -58,37 +77,88 @@ identifier_case = {self.user_profile['naming_convention']}
             return parts[0].lower() + ''.join(x.title() for x in parts[1:])
 
         def to_snake_case(name: str) -> str:
-            return re.sub(r'(?<!^)(?=[A-Z])', '_', name).lower()
+            return _SNAKE_RE.sub('_', name).lower()
 
         def to_pascal_case(name: str) -> str:
             return ''.join(x.title() for x in name.split('_'))
 
         class StyleTransformer(ast.NodeTransformer):
-            def __init__(self, profile):
+            def __init__(self, profile, defined_names):
                 self.profile = profile
+                self.defined_names = defined_names
+                self._converter = {
+                    "camelCase": to_camel_case,
+                    "snake_case": to_snake_case,
+                    "PascalCase": to_pascal_case
+                }.get(profile['naming_convention'])
+                self._cache = {}
                 super().__init__()
 
+            def _convert(self, name: str) -> str:
+                if self._converter is None:
+                    return name
+                converted = self._cache.get(name)
+                if converted is None:
+                    converted = self._cache[name] = self._converter(name)
+                return converted
+
             def visit_FunctionDef(self, node):
                 # Naming convention for function names
-                if self.profile['naming_convention'] == "camelCase":
-                    node.name = to_camel_case(node.name)
-                elif self.profile['naming_convention'] == "snake_case":
-                    node.name = to_snake_case(node.name)
-                elif self.profile['naming_convention'] == "PascalCase":
-                    node.name = to_pascal_case(node.name)
+                node.name = self._convert(node.name)
                 return self.generic_visit(node)
 
             def visit_Name(self, node):
-                # Variable names
-                if self.profile['naming_convention'] == "camelCase":
-                    node.id = to_camel_case(node.id)
-                elif self.profile['naming_convention'] == "snake_case":
-                    node.id = to_snake_case(node.id)
-                elif self.profile['naming_convention'] == "PascalCase":
-                    node.id = to_pascal_case(node.id)
+                # Variable names; builtins and imported symbols are never bound here, so stay untouched
+                if node.id in self.defined_names:
+                    node.id = self._convert(node.id)
                 return node
 
-        return StyleTransformer(self.user_profile).visit(tree)
+            def visit_Global(self, node):
+                node.names = [self._convert(n) if n in self.defined_names else n for n in node.names]
+                return node
+
+            visit_Nonlocal = visit_Global
+
+        defined_names = set()
+        # Names bound by forms that are never renamed (parameters, which callers may pass by
+        # keyword; except-as targets; imports; classes) must keep every occurrence unchanged
+        fixed_names = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+                defined_names.add(node.id)
+            elif isinstance(node, ast.FunctionDef):
+                defined_names.add(node.name)
+            elif isinstance(node, ast.arg):
+                fixed_names.add(node.arg)
+            elif isinstance(node, ast.ExceptHandler) and node.name:
+                fixed_names.add(node.name)
+            elif isinstance(node, (ast.Import, ast.ImportFrom)):
+                fixed_names.update((alias.asname or alias.name).split('.')[0] for alias in node.names)
+            elif isinstance(node, (ast.ClassDef, ast.AsyncFunctionDef)):
+                fixed_names.add(node.name)
+        return StyleTransformer(self.user_profile, defined_names - fixed_names).visit(tree)
+
+    def adapt_code_snippet(self, code: str) -> str:
+        """Rewrite a source snippet to the user's style; unparsable code is returned unchanged"""
+        return self.adapt_code_snippets([code])[0]
+
+    def adapt_code_snippets(self, snippets: List[str]) -> List[str]:
+        """Batch form of adapt_code_snippet, preserving input order"""
+        adapted = []
+        for code in snippets:
+            try:
+                tree = ast.parse(code)
+                shape = _binding_shape(tree)
+                new_code = ast.unparse(self.adapt_ast(tree))
+                # Reject rewrites that merged two names or captured/unbound a free one
+                if _binding_shape(ast.parse(new_code)) != shape:
+                    logging.warning("Style adaptation changed name bindings; keeping original snippet")
+                    new_code = code
+                adapted.append(new_code)
+            except SyntaxError as e:
+                logging.warning(f"Style adaptation skipped unparsable snippet: {e}")
+                adapted.append(code)
+        return adapted
 
 # Example usage
 if __name__ == "__main__":
@@ -100,3 +170,11 @@ if __name__ == "__main__":
     tree = ast.parse(sample_code)
     adapted_tree = adapter.adapt_ast(tree)
     print("Adapted AST:", ast.dump(adapted_tree, indent=4))
+
+    # Adapted code must still run: reassigned parameters keep their original name
+    param_code = "def computeTotal(itemCount):\n    itemCount = itemCount + 1\n    return itemCount"
+    adapted_code = adapter.adapt_code_snippet(param_code)
+    namespace = {}
+    exec(adapted_code, namespace)
+    assert namespace["compute_total"](itemCount=1) == 2, adapted_code
+    print("Adapted code:\n", adapted_code)
@@ -3,17 +3,89 @@ import sqlite3
 import os
 import json
 import hashlib
-from typing import Dict, Any
+import threading
+import queue
+import weakref
+import time
+from typing import Dict, Any, List, Tuple
 import logging
 
 logging.basicConfig(filename='telemetry.log', level=logging.INFO)
 
+INSERT_SQL = (
+    "INSERT INTO interactions (event_type, suggestion_id, encrypted_payload, anonymized_user_id, metadata) "
+    "VALUES (?, ?, ?, ?, ?)"
+)
+WRITE_BATCH_SIZE = 256
+WRITE_LINGER = 0.05  # seconds the writer waits to fill a batch once it has a row
+
+
+def _writer_loop(write_q: queue.Queue, conn: sqlite3.Connection, cursor: sqlite3.Cursor,
+                 lock: threading.Lock):
+    """Drain queued rows and commit up to WRITE_BATCH_SIZE of them per transaction
+
+    Takes the connection state rather than the TelemetryDB so the thread does not keep
+    the instance alive. Items are single rows or lists of rows; a None item stops the loop.
+    """
+    stopping = False
+    while not stopping:
+        batch = []
+        items = 0
+        item = write_q.get()
+        deadline = time.monotonic() + WRITE_LINGER
+        while True:
+            items += 1
+            if item is None:
+                stopping = True
+            elif isinstance(item, list):
+                batch.extend(item)
+            else:
+                batch.append(item)
+            remaining = deadline - time.monotonic()
+            if stopping or len(batch) >= WRITE_BATCH_SIZE or remaining <= 0:
+                break
+            try:
+                item = write_q.get(timeout=remaining)
+            except queue.Empty:
+                break
+        try:
+            if batch:
+                with lock, conn:
+                    cursor.executemany(INSERT_SQL, batch)
+        except Exception as e:
+            logging.error(f"Telemetry write failed: {e}")
+        finally:
+            for _ in range(items):
+                write_q.task_done()
+
+
+def _shutdown_writer(write_q: queue.Queue, writer: threading.Thread, conn: sqlite3.Connection):
+    """Commit what is queued, stop the writer and close the connection"""
+    write_q.put(None)
+    writer.join()
+    conn.close()
+
 class TelemetryDB:
     def __init__(self, db_path=":memory:", key_path="telemetry.key"):
-        self.conn = sqlite3.connect(db_path)
+        # Shared with AnalyticsBridge's background sync thread; access is serialized by self.lock
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
         self.cursor = self.conn.cursor()
+        self.lock = threading.Lock()
+        self._tune_connection()
         self._create_table()
         self.key = self._load_or_generate_key(key_path)
+        self._aesgcm = AESGCM(self.key)
+        self._user_id = self._generate_user_id()
+        # record_interaction only enqueues; a single writer thread commits rows in batches
+        self._write_q: queue.Queue = queue.Queue()
+        self._writer = threading.Thread(
+            target=_writer_loop, args=(self._write_q, self.conn, self.cursor, self.lock), daemon=True
+        )
+        self._writer.start()
+        self._close_lock = threading.Lock()
+        # Runs once: on close(), when the instance is collected, or at interpreter exit (the
+        # writer is a daemon, so queued rows would otherwise be lost); holds no reference to self
+        self._finalizer = weakref.finalize(self, _shutdown_writer, self._write_q, self._writer, self.conn)
 
     def _load_or_generate_key(self, key_path: str) -> bytes:
         """Load AES key from disk, generate if not present"""
@@ -25,6 +97,14 @@ class TelemetryDB:
             f.write(key)
         return key
 
+    def _tune_connection(self):
+        """WAL journaling with relaxed fsync and in-memory temp storage"""
+        self.cursor.execute("PRAGMA journal_mode=WAL")
+        self.cursor.execute("PRAGMA synchronous=NORMAL")
+        self.cursor.execute("PRAGMA temp_store=MEMORY")
+        self.cursor.execute("PRAGMA mmap_size=268435456")  # 256 MiB
+        self.cursor.execute("PRAGMA cache_size=-65536")  # 64 MiB
+
     def _create_table(self):
         self.cursor.execute("""
         CREATE TABLE IF NOT EXISTS interactions (
@@ -37,57 +117,94 @@ class TelemetryDB:
             metadata TEXT
         )
         """)
+        # Covering index for the acceptance-ratio aggregation in get_adaptation_data
+        self.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_sugg_event ON interactions(suggestion_id, event_type)"
+        )
         self.conn.commit()
 
     def _generate_user_id(self) -> str:
-        """Anonymized user ID (8 hex chars)"""
+        """Anonymized per-session user ID (8 hex chars)"""
         rand_bytes = os.urandom(16)
         return hashlib.sha256(rand_bytes).hexdigest()[:8]
 
     def encrypt_payload(self, payload: Dict[str, Any]) -> bytes:
         """AES-GCM encryption with automatic IV handling"""
         iv = os.urandom(12)
-        aesgcm = AESGCM(self.key)
         plaintext = json.dumps(payload).encode()
-        ciphertext = aesgcm.encrypt(iv, plaintext, None)
+        ciphertext = self._aesgcm.encrypt(iv, plaintext, None)
         return iv + ciphertext
 
     def decrypt_payload(self, encrypted: bytes) -> Dict[str, Any]:
         """AES-GCM decryption"""
         iv, ciphertext = encrypted[:12], encrypted[12:]
-        aesgcm = AESGCM(self.key)
-        plaintext = aesgcm.decrypt(iv, ciphertext, None)
+        plaintext = self._aesgcm.decrypt(iv, ciphertext, None)
         return json.loads(plaintext.decode())
 
+    def _build_row(self, event_type: str, suggestion_id: str,
+                   context_embedding: bytes, metadata: Dict[str, Any] = None) -> Tuple:
+        """Encrypt one interaction into an insertable row"""
+        payload = {
+            "event": event_type,
+            "suggestion_id": suggestion_id,
+            "context_sha256": hashlib.sha256(context_embedding).hexdigest()[:16]
+        }
+        encrypted = self.encrypt_payload(payload)
+        return (event_type, suggestion_id, encrypted, self._user_id, json.dumps(metadata or {}))
+
     def record_interaction(self, event_type: str, suggestion_id: str,
                            context_embedding: bytes, metadata: Dict[str, Any] = None):
-        """Store encrypted interaction record"""
+        """Encrypt an interaction record and queue it for the background writer"""
         try:
-            payload = {
-                "event": event_type,
-                "suggestion_id": suggestion_id,
-                "context_sha256": hashlib.sha256(context_embedding).hexdigest()[:16]
-            }
-            encrypted = self.encrypt_payload(payload)
-            user_id = self._generate_user_id()
-            self.cursor.execute(
-                "INSERT INTO interactions (event_type, suggestion_id, encrypted_payload, anonymized_user_id, metadata) VALUES (?, ?, ?, ?, ?)",
-                (event_type, suggestion_id, encrypted, user_id, json.dumps(metadata or {}))
-            )
-            self.conn.commit()
+            row = self._build_row(event_type, suggestion_id, context_embedding, metadata)
+            with self._close_lock:
+                if not self._finalizer.alive:
+                    logging.error(f"Telemetry dropped for {suggestion_id}: database is closed")
+                    return
+                self._write_q.put(row)
         except Exception as e:
             logging.error(f"Telemetry failed: {e}")
 
+    def record_interactions(self, events: List[Dict[str, Any]]):
+        """Encrypt a batch of interaction records and queue them for the background writer
+
+        Each event is a dict with the keyword arguments of record_interaction. The rows
+        are committed together, merged with whatever else is queued.
+        """
+        try:
+            rows = [self._build_row(**event) for event in events]
+            if not rows:
+                return
+            with self._close_lock:
+                if not self._finalizer.alive:
+                    logging.error(f"Telemetry dropped {len(rows)} events: database is closed")
+                    return
+                self._write_q.put(rows)
+        except Exception as e:
+            logging.error(f"Telemetry batch failed: {e}")
+
+    def flush(self):
+        """Block until every queued interaction has been committed"""
+        if self._finalizer.alive:  # after close() the writer has already drained the queue
+            self._write_q.join()
+
+    def close(self):
+        """Flush pending writes, stop the writer thread and close the connection; safe to repeat"""
+        with self._close_lock:
+            self._finalizer()
+
     def get_adaptation_data(self) -> Dict[str, float]:
         """Compute acceptance ratios for reinforcement learning"""
-        self.cursor.execute("""
-        SELECT suggestion_id, 
-               SUM(CASE WHEN event_type='ACCEPTED' THEN 1 ELSE 0 END) AS accepts,
-               COUNT(*) AS total
-        FROM interactions
-        GROUP BY suggestion_id
-        """)
-        return {row[0]: row[1] / row[2] for row in self.cursor.fetchall()}
+        self.flush()  # include interactions still waiting on the writer
+        with self.lock:
+            self.cursor.arraysize = 1000
+            self.cursor.execute("""
+            SELECT suggestion_id,
+                   CAST(SUM(CASE WHEN event_type='ACCEPTED' THEN 1 ELSE 0 END) AS REAL) / COUNT(*)
+            FROM interactions
+            GROUP BY suggestion_id
+            """)
+            return dict(self.cursor)
 
 # Example usage
 if __name__ == "__main__":
@@ -98,7 +215,7 @@ if __name__ == "__main__":
 
     print("Adaptation ratios:", db.get_adaptation_data())
 
-    # Retrieve & decrypt one record (demo)
+    # Retrieve & decrypt one record (demo; get_adaptation_data above already flushed the writer)
     db.cursor.execute("SELECT encrypted_payload FROM interactions LIMIT 1")
     encrypted_payload = db.cursor.fetchone()[0]
     print("Decrypted payload:", db.decrypt_payload(encrypted_payload))
@@ -1,26 +1,125 @@
 import ast
+import numpy as np
+import re
 import torch
-from transformers import CodeBertModel, BertTokenizer
+from transformers import CodeBertModel, AutoTokenizer
 import logging
 import os
 import hashlib
-from typing import Dict, List, Optional
+import mmap
+from typing import Any, Dict, List, Optional, Set, Tuple
 import asyncio
+import threading
 import tokenize
+from collections import OrderedDict
 from io import StringIO
+from security_module.rules import call_name, call_risk
 
 logging.basicConfig(filename='context_analyzer.log', level=logging.INFO,
                     format='%(asctime)s:%(levelname)s:%(message)s')
 
+_TOKEN_RE = re.compile(r"\w+")
+SIMHASH_MAX_DISTANCE = 3  # bits; edits this small reuse the previous embedding
+ANALYSIS_CACHE_SIZE = 512  # distinct code versions whose analysis results are kept
+EMBEDDING_CACHE_SIZE = 4096  # cached FP16 file embeddings (~1.5 KiB each at 768 dims)
+
+
+def _simhash(text: str) -> int:
+    """64-bit SimHash over identifier/number tokens; near-identical texts differ in few bits"""
+    tokens = _TOKEN_RE.findall(text)
+    if not tokens:
+        return 0
+    hashes = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(t.encode(), digest_size=8).digest(), "little") for t in tokens),
+        dtype=np.uint64, count=len(tokens)
+    )
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder="little")
+    votes = bits.sum(axis=0, dtype=np.int64) * 2 > len(tokens)
+    return int(np.packbits(votes, bitorder="little").view("<u8")[0])
+
+
+class _ContextScanVisitor(ast.NodeVisitor):
+    """Single AST walk that accumulates both the context summary and risky call sites
+
+    Which calls are risky, and how much, is defined by security_module.rules.
+    """
+
+    def __init__(self):
+        self.functions: List[str] = []
+        self.classes: List[str] = []
+        self.imports: set = set()
+        self.call_count = 0
+        self.findings: List[Dict[str, Any]] = []
+
+    def visit_FunctionDef(self, node):
+        self.functions.append(node.name)
+        self.generic_visit(node)
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_ClassDef(self, node):
+        self.classes.append(node.name)
+        self.generic_visit(node)
+
+    def visit_Import(self, node):
+        self.imports.update(alias.name for alias in node.names)
+
+    def visit_ImportFrom(self, node):
+        if node.module:
+            self.imports.add(node.module)
+
+    def visit_Call(self, node):
+        self.call_count += 1
+        name = call_name(node.func)
+        risk = call_risk(node, name)
+        if risk is not None:
+            self.findings.append({"type": name, "risk_score": risk, "line": node.lineno})
+        self.generic_visit(node)
+
 
 class ContextAnalyzer:
     def __init__(self, model_name="microsoft/codebert-base", device: Optional[str] = None):
-        self.tokenizer = BertTokenizer.from_pretrained(model_name)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
         self.model = CodeBertModel.from_pretrained(model_name)
         self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
         self.model.to(self.device)
+        self.model.eval()
+        if self.device.startswith("cuda"):
+            self.model = self.model.to(torch.bfloat16)
+            self._try_compile()
         self.ast_cache: Dict[str, ast.Module] = {}
-        self.embedding_cache: Dict[str, Dict[str, torch.Tensor]] = {}  
+        # Keyed by content hash so identical files share one embedding; stored as FP16,
+        # least recently used first and capped at EMBEDDING_CACHE_SIZE
+        self.embedding_cache: "OrderedDict[str, torch.Tensor]" = OrderedDict()
+        # path -> (simhash, content hash) of the version last actually embedded, and the
+        # reverse index used to drop anchors whose embedding is evicted
+        self._embedded_versions: Dict[str, Tuple[int, str]] = {}
+        self._anchor_paths: Dict[str, Set[str]] = {}
+        self._embedding_lock = threading.Lock()  # files are hashed on concurrent to_thread workers
+        # code hash -> (context_report, vuln_report), least recently used first
+        self._analysis_cache: "OrderedDict[str, Tuple[Dict[str, Any], List[Dict[str, Any]]]]" = OrderedDict()
+        self._analysis_lock = threading.Lock()
+
+    def _try_compile(self):
+        """Swap in a torch.compile'd model, keeping the eager one if compilation fails
+
+        Compilation is lazy, so a warm-up forward runs here to surface Inductor/Triton
+        errors. dynamic=True avoids recompiling for every padded batch shape.
+        """
+        eager = self.model
+        try:
+            compiled = torch.compile(eager, dynamic=True)
+            with torch.inference_mode():
+                compiled(**self._tokenize(["def f():\n    pass"]))
+            self.model = compiled
+        except Exception as e:
+            logging.warning(f"torch.compile failed, using eager model: {e}")
+            self.model = eager
+
+    def _tokenize(self, codes: List[str]) -> Dict[str, torch.Tensor]:
+        """Padded, truncated CodeBERT inputs on the model device"""
+        inputs = self.tokenizer(codes, return_tensors="pt", padding=True, truncation=True, max_length=512)
+        return {k: v.to(self.device) for k, v in inputs.items()}
 
     def incremental_parse(self, file_path: str, new_code: str) -> ast.Module:
         """Parse code incrementally with AST fallback to lexical scanning on failure"""
@@ -44,44 +143,172 @@ class ContextAnalyzer:
             logging.error(f"Lexical scan failed: {e}")
             return ast.Module(body=[], type_ignores=[])
 
+    def analyze_and_scan(self, code: str) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+        """Parse once and produce (context_report, vuln_report) from a single AST traversal"""
+        try:
+            tree = ast.parse(code)
+        except SyntaxError as e:
+            logging.error(f"AST failed during analysis: {e}")
+            return {"parse_error": str(e)}, []
+        visitor = _ContextScanVisitor()
+        visitor.visit(tree)
+        context_report = {
+            "functions": visitor.functions,
+            "classes": visitor.classes,
+            "imports": sorted(visitor.imports),
+            "call_count": visitor.call_count,
+            "loc": code.count("\n") + 1
+        }
+        return context_report, visitor.findings
+
+    @staticmethod
+    def code_hash(code: str) -> str:
+        """Cheap content key for analysis caching"""
+        return hashlib.blake2b(code.encode("utf-8"), digest_size=16).hexdigest()
+
+    def analyze_cached(self, code_hash: str, code: str) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+        """analyze_and_scan with an LRU keyed by code hash; re-submitted code skips the AST pass
+
+        Cached reports are shared between callers and must be treated as read-only.
+        """
+        with self._analysis_lock:
+            cached = self._analysis_cache.get(code_hash)
+            if cached is not None:
+                self._analysis_cache.move_to_end(code_hash)
+                return cached
+        result = self.analyze_and_scan(code)
+        with self._analysis_lock:
+            self._analysis_cache[code_hash] = result
+            if len(self._analysis_cache) > ANALYSIS_CACHE_SIZE:
+                self._analysis_cache.popitem(last=False)
+        return result
+
     def _file_hash(self, file_path: str) -> str:
-        """Compute a SHA256 hash of file contents"""
+        """Compute a SHA256 hash of file contents via a read-only memory map"""
         if not os.path.exists(file_path):
             return ""
         with open(file_path, "rb") as f:
-            return hashlib.sha256(f.read()).hexdigest()
+            if os.fstat(f.fileno()).st_size == 0:
+                return hashlib.sha256(b"").hexdigest()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return hashlib.sha256(mm).hexdigest()
 
-    async def get_context_embedding(self, file_paths: List[str]) -> torch.Tensor:
-        """Generate CodeBERT embeddings for cross-file context with caching"""
-        all_code = ""
-        for path in file_paths:
-            if os.path.exists(path):
-                file_hash = self._file_hash(path)
-                cached = self.embedding_cache.get(path)
-                if cached and cached.get("hash") == file_hash:
-                    logging.info(f"Using cached embedding for {path}")
-                    all_code += ""  
-                    continue
-                with open(path, "r", encoding="utf-8") as f:
-                    all_code += f.read() + "\n"
-
-        if not all_code.strip():
-            logging.warning("No new code to embed, returning zero vector")
-            return torch.zeros(1, 768, device=self.device)
+    def _cache_get(self, file_hash: str) -> Optional[torch.Tensor]:
+        """Cached embedding for a content hash, marking it most recently used"""
+        with self._embedding_lock:
+            cached = self.embedding_cache.get(file_hash)
+            if cached is not None:
+                self.embedding_cache.move_to_end(file_hash)
+            return cached
 
-        try:
-            inputs = self.tokenizer(all_code, return_tensors="pt", truncation=True, max_length=512)
-            inputs = {k: v.to(self.device) for k, v in inputs.items()}
+    def _cache_put(self, file_hash: str, embedding: torch.Tensor):
+        """Insert an embedding, evicting the least recently used ones and their anchors"""
+        with self._embedding_lock:
+            self.embedding_cache[file_hash] = embedding
+            self.embedding_cache.move_to_end(file_hash)
+            while len(self.embedding_cache) > EMBEDDING_CACHE_SIZE:
+                evicted, _ = self.embedding_cache.popitem(last=False)
+                for path in self._anchor_paths.pop(evicted, ()):
+                    self._embedded_versions.pop(path, None)
+
+    def _set_anchor(self, path: str, simhash: int, file_hash: str):
+        """Record the version of a path that was last actually embedded"""
+        with self._embedding_lock:
+            if file_hash not in self.embedding_cache:
+                return  # already evicted; nothing to reuse
+            previous = self._embedded_versions.get(path)
+            if previous is not None:
+                paths = self._anchor_paths.get(previous[1])
+                if paths is not None:
+                    paths.discard(path)
+                    if not paths:
+                        del self._anchor_paths[previous[1]]
+            self._embedded_versions[path] = (simhash, file_hash)
+            self._anchor_paths.setdefault(file_hash, set()).add(path)
+
+    def _read_and_hash(
+        self, path: str
+    ) -> Optional[Tuple[str, str, Optional[str], Optional[int], Optional[torch.Tensor]]]:
+        """Hash a file and read its text only when its embedding is not cached
+
+        Returns (path, hash, text, simhash, cached embedding); text is None on a cache hit.
+        A file whose exact content is new, but whose SimHash is within
+        SIMHASH_MAX_DISTANCE bits of the last embedded version of the same path,
+        reuses that version's embedding.
+        """
+        if not os.path.exists(path):
+            return None
+        file_hash = self._file_hash(path)
+        cached = self._cache_get(file_hash)
+        if cached is not None:
+            return path, file_hash, None, None, cached
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        simhash = _simhash(text)
+        anchor = self._embedded_versions.get(path)
+        if anchor is not None:
+            anchor_simhash, anchor_hash = anchor
+            cached = self._cache_get(anchor_hash)
+            if cached is not None and bin(simhash ^ anchor_simhash).count("1") <= SIMHASH_MAX_DISTANCE:
+                self._cache_put(file_hash, cached)
+                return path, file_hash, None, simhash, cached
+        return path, file_hash, text, simhash, None
+
+    def _embed(self, codes: List[str]) -> torch.Tensor:
+        """Blocking batched CodeBERT forward pass returning one mean-pooled row per input"""
+        inputs = self._tokenize(codes)
+        with torch.inference_mode():
             outputs = self.model(**inputs)
-            embedding = outputs.last_hidden_state.mean(dim=1)
+        mask = inputs["attention_mask"].unsqueeze(-1).to(outputs.last_hidden_state.dtype)
+        return (outputs.last_hidden_state * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+
+    def _pool(self, embeddings: List[torch.Tensor]) -> torch.Tensor:
+        """Average FP16 per-file embeddings into a (1, 768) FP32 context vector"""
+        if len(embeddings) == 1:
+            return embeddings[0].float().unsqueeze(0)
+        return torch.stack(embeddings).float().mean(dim=0, keepdim=True)
+
+    async def get_context_embedding(self, file_paths: List[str]) -> torch.Tensor:
+        """Generate CodeBERT embeddings for cross-file context with caching
 
-            
-            for path in file_paths:
-                if os.path.exists(path):
-                    file_hash = self._file_hash(path)
-                    self.embedding_cache[path] = {"hash": file_hash, "embedding": embedding}
+        Each file is embedded separately and the per-file embeddings are averaged.
+        """
+        results = await asyncio.gather(
+            *[asyncio.to_thread(self._read_and_hash, path) for path in file_paths]
+        )
+        file_hashes: List[str] = []
+        # Embeddings used by this call, held here so concurrent evictions cannot drop them mid-call
+        found: Dict[str, torch.Tensor] = {}
+        pending: Dict[str, str] = {}  # content hash -> text still to embed
+        new_versions: Dict[str, Tuple[int, str]] = {}
+        for result in results:
+            if result is None:
+                continue
+            path, file_hash, text, simhash, cached = result
+            file_hashes.append(file_hash)
+            if text is None:
+                logging.info(f"Using cached embedding for {path}")
+                found[file_hash] = cached
+                continue
+            pending[file_hash] = text
+            new_versions[path] = (simhash, file_hash)
 
-            return embedding
+        if not file_hashes:
+            logging.warning("No code to embed, returning zero vector")
+            return torch.zeros(1, 768, device=self.device)
+
+        if not pending:
+            # Every file hit the cache: skip the tokenizer and model entirely
+            return self._pool([found[h] for h in file_hashes])
+
+        try:
+            embeddings = await asyncio.to_thread(self._embed, list(pending.values()))
+            for file_hash, embedding in zip(pending, embeddings):
+                found[file_hash] = embedding.to(torch.float16)
+                self._cache_put(file_hash, found[file_hash])
+            for path, (simhash, file_hash) in new_versions.items():
+                self._set_anchor(path, simhash, file_hash)
+            return self._pool([found[h] for h in file_hashes])
         except Exception as e:
             logging.critical(f"Embedding generation failed: {e}")
             return torch.zeros(1, 768, device=self.device)
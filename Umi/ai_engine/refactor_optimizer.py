@@ -1,45 +1,67 @@
 import ast
+import bisect
 import numpy as np
 import torch
-from sklearn.ensemble import RandomForestRegressor
 from context_analyzer import ContextAnalyzer
+from regex_engine import compile_pattern
 import logging
+import os
 import re
-from typing import Dict, List
+from typing import Dict, List, TYPE_CHECKING
 import asyncio
 
+if TYPE_CHECKING:
+    from sklearn.ensemble import RandomForestRegressor
+
 logging.basicConfig(filename='refactor_optimizer.log', level=logging.INFO,
                     format='%(asctime)s:%(levelname)s:%(message)s')
 
+# Next to this module rather than the cwd, so joblib.load never unpickles a file from wherever we run
+IMPACT_MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "impact_model.joblib")
+
 
 class RefactorOptimizer:
-    def __init__(self, context_analyzer: ContextAnalyzer):
+    def __init__(self, context_analyzer: ContextAnalyzer, impact_model_path: str = IMPACT_MODEL_PATH):
         self.context = context_analyzer
         self.pattern_registry = self._load_patterns()
-        self.impact_model = self._train_impact_model()
+        self.impact_model_path = impact_model_path
+        self._impact_model = None
+
+    @property
+    def impact_model(self) -> "RandomForestRegressor":
+        """Impact regressor used by rank_optimizations, trained or loaded on first access"""
+        if self._impact_model is None:
+            self._impact_model = self._train_impact_model()
+        return self._impact_model
 
     def _load_patterns(self) -> Dict[str, dict]:
         """Load anti-patterns from predefined rules with severity scores"""
         return {
             "NestedLoop": {
-                "pattern": r"for\s+.*:\s*\n\s*for\s+.*:",
+                "pattern": compile_pattern(r"for\s+.*:\s*\n\s*for\s+.*:", multiline=True),
                 "severity": 0.8,
                 "fix": "Consider vectorization (NumPy/Pandas) or itertools.product"
             },
             "RedundantCall": {
-                "pattern": r"(\w+)\s*=\s*\1\(\)",  # foo = foo()
+                "pattern": compile_pattern(r"(\w+)\s*=\s*\1\(\)", multiline=True),  # foo = foo()
                 "severity": 0.6,
                 "fix": "Memoize or cache result instead of redundant calls"
             },
             "UncheckedInput": {
-                "pattern": r"input\s*\(.*\)",
+                "pattern": compile_pattern(r"input\s*\(.*\)", multiline=True),
                 "severity": 0.9,
                 "fix": "Validate and sanitize user input"
             }
         }
 
-    def _train_impact_model(self) -> RandomForestRegressor:
-        """Train ML model on synthetic performance impact dataset"""
+    def _train_impact_model(self) -> "RandomForestRegressor":
+        """Train ML model on synthetic performance impact dataset, reusing the on-disk copy"""
+        import joblib
+        from sklearn.ensemble import RandomForestRegressor
+
+        if os.path.exists(self.impact_model_path):
+            return joblib.load(self.impact_model_path)
+
         # Synthetic features: [severity, snippet_length, context_mean]
         X = np.array([
             [0.8, 50, 0.1],
@@ -49,15 +71,21 @@ class RefactorOptimizer:
         y = np.array([0.85, 0.15, 0.92])  # Performance impact scores
         model = RandomForestRegressor(n_estimators=100, random_state=42)
         model.fit(X, y)
+        try:
+            joblib.dump(model, self.impact_model_path)
+        except OSError as e:
+            logging.warning(f"Could not cache impact model at {self.impact_model_path}: {e}")
         return model
 
     def detect_anti_patterns(self, code: str) -> List[dict]:
         """Scan code for registered inefficiency patterns with location tracking"""
         findings = []
+        # Sorted newline offsets: a match's line is the count of newlines before it
+        newlines = [m.start() for m in re.finditer("\n", code)]
         for name, rule in self.pattern_registry.items():
-            matches = re.finditer(rule["pattern"], code, re.MULTILINE)
+            matches = rule["pattern"].finditer(code)
             for match in matches:
-                start_line = code[:match.start()].count('\n') + 1
+                start_line = bisect.bisect_left(newlines, match.start()) + 1
                 findings.append({
                     "pattern": name,
                     "severity": rule["severity"],
@@ -0,0 +1,23 @@
+import re
+import logging
+
+try:
+    import re2  # optional linear-time (DFA) regex engine
+except ImportError:
+    re2 = None
+
+_BACKREF_RE = re.compile(r"\\[1-9]|\(\?P=")  # constructs RE2 rejects outright
+
+if re2 is not None:
+    _RE2_OPTIONS = re2.Options()
+    _RE2_OPTIONS.log_errors = False  # unsupported syntax falls back to re; keep stderr quiet
+
+
+def compile_pattern(pattern: str, multiline: bool = False):
+    """Compile with RE2 when installed, falling back to re for syntax RE2 lacks (e.g. backreferences)"""
+    if re2 is not None and not _BACKREF_RE.search(pattern):
+        try:
+            return re2.compile(f"(?m){pattern}" if multiline else pattern, options=_RE2_OPTIONS)
+        except re2.error as e:
+            logging.debug(f"RE2 rejected {pattern!r} ({e}), using re")
+    return re.compile(pattern, re.MULTILINE if multiline else 0)
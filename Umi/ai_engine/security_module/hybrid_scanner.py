@@ -1,8 +1,10 @@
 import re
+import bisect
 import numpy as np
 import torch
-from transformers import pipeline, AutoTokenizer, AutoModelForSequenceClassification
 from context_analyzer import ContextAnalyzer
+from regex_engine import compile_pattern
+from security_module.rules import OWASP_RULES
 import logging
 import asyncio
 from typing import List, Dict
@@ -13,58 +15,73 @@ logging.basicConfig(filename='hybrid_scanner.log', level=logging.WARNING)
 class HybridScanner:
     def __init__(self):
         self.owasp_rules = self._load_owasp_rules()
+        self._rule_by_name = {rule["name"]: rule for rule in self.owasp_rules}
+        # Single alternation so rule_based_scan classifies every rule in one pass over the code
+        self._combined = compile_pattern("|".join(
+            f"(?P<{rule['name']}>{rule['pattern'].pattern})" for rule in self.owasp_rules
+        ))
+        self._anomaly_detector = None
 
-        # Use a generic text classifier (placeholder: you should fine-tune CodeBERT for vuln detection)
-        model_name = "microsoft/codebert-base"  # NOTE: not actually trained for classification
-        self.anomaly_detector = pipeline(
-            "text-classification",
-            model=AutoModelForSequenceClassification.from_pretrained("distilbert-base-uncased-finetuned-sst-2-english"),
-            tokenizer=AutoTokenizer.from_pretrained("distilbert-base-uncased-finetuned-sst-2-english")
-        )
+    @property
+    def anomaly_detector(self):
+        """Text classifier used by ml_validation, loaded on first access"""
+        if self._anomaly_detector is None:
+            from transformers import pipeline, AutoTokenizer, AutoModelForSequenceClassification
+
+            # Use a generic text classifier (placeholder: you should fine-tune CodeBERT for vuln detection)
+            model_name = "microsoft/codebert-base"  # NOTE: not actually trained for classification
+            self._anomaly_detector = pipeline(
+                "text-classification",
+                model=AutoModelForSequenceClassification.from_pretrained("distilbert-base-uncased-finetuned-sst-2-english"),
+                tokenizer=AutoTokenizer.from_pretrained("distilbert-base-uncased-finetuned-sst-2-english")
+            )
+        return self._anomaly_detector
 
     def _load_owasp_rules(self) -> List[Dict]:
         """Load OWASP Top 10 patterns with risk weights"""
-        return [
-            {"name": "SQLi", "pattern": r"execute\(.*?\+.*?\)", "risk": 0.95},
-            {"name": "XSS", "pattern": r"innerHTML\s*=\s*[^\"']*?[\+\{\$]", "risk": 0.90},
-            {"name": "CmdInjection", "pattern": r"os\.system\(.*?\+.*?\)", "risk": 0.97}
-        ]
+        return [{**rule, "pattern": re.compile(rule["pattern"])} for rule in OWASP_RULES]
 
     def rule_based_scan(self, code: str) -> List[Dict]:
         """First-pass detection using regex patterns"""
         findings = []
-        for rule in self.owasp_rules:
-            matches = re.finditer(rule["pattern"], code)
-            for match in matches:
-                findings.append({
-                    "type": rule["name"],
-                    "risk_score": rule["risk"],
-                    "line": code[:match.start()].count('\n') + 1,
-                    "snippet": match.group(0)
-                })
+        newlines = [m.start() for m in re.finditer("\n", code)]
+        for match in self._combined.finditer(code):
+            rule = self._rule_by_name[match.lastgroup]
+            findings.append({
+                "type": rule["name"],
+                "risk_score": rule["risk"],
+                "line": bisect.bisect_left(newlines, match.start()) + 1,
+                "snippet": match.group(0)
+            })
         return findings
 
     def ml_validation(self, findings: List[Dict], context_embedding) -> List[Dict]:
         """Second-pass verification via anomaly detection"""
+        if not findings:
+            return []
+        try:
+            # One batched pipeline call; with top_k each result is a list of label dicts
+            ml_results = self.anomaly_detector(
+                [finding["snippet"] for finding in findings],
+                top_k=2,
+                truncation=True,
+                batch_size=32
+            )
+        except Exception as e:
+            logging.error(f"ML validation failed: {e}")
+            return []
+
+        context_norm = float(torch.norm(context_embedding).item())
         validated = []
-        for finding in findings:
-            try:
-                ml_result = self.anomaly_detector(
-                    finding["snippet"],
-                    top_k=2,
-                    truncation=True
+        for finding, ml_result in zip(findings, ml_results):
+            # Check for 'LABEL_1' (positive) as malicious in SST-2 model
+            if ml_result[0]['label'] in ['LABEL_1', 'POSITIVE'] and ml_result[0]['score'] > 0.8:
+                finding["confidence"] = float(ml_result[0]['score'])
+                finding["context_aware_risk"] = min(
+                    1.0,
+                    finding["risk_score"] * context_norm / 10
                 )
-
-                # Check for 'LABEL_1' (positive) as malicious in SST-2 model
-                if ml_result[0]['label'] in ['LABEL_1', 'POSITIVE'] and ml_result[0]['score'] > 0.8:
-                    finding["confidence"] = float(ml_result[0]['score'])
-                    finding["context_aware_risk"] = min(
-                        1.0,
-                        finding["risk_score"] * float(torch.norm(context_embedding).item() / 10)
-                    )
-                    validated.append(finding)
-            except Exception as e:
-                logging.error(f"ML validation failed: {e}")
+                validated.append(finding)
         return sorted(validated, key=lambda x: x.get("context_aware_risk", 0), reverse=True)
 
     def generate_mitigation(self, finding: Dict) -> str:
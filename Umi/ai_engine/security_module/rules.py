@@ -0,0 +1,45 @@
+import ast
+from typing import Optional
+
+# Single source of vulnerability rules and their risk weights, shared by HybridScanner's
+# regex pass and ContextAnalyzer's fused AST pass
+
+# OWASP Top 10 source patterns matched by HybridScanner.rule_based_scan
+OWASP_RULES = [
+    {"name": "SQLi", "pattern": r"execute\(.*?\+.*?\)", "risk": 0.95},
+    {"name": "XSS", "pattern": r"innerHTML\s*=\s*[^\"']*?[\+\{\$]", "risk": 0.90},
+    {"name": "CmdInjection", "pattern": r"os\.system\(.*?\+.*?\)", "risk": 0.97}
+]
+
+# Call targets flagged by the AST pass, with risk weights
+RISKY_CALLS = {
+    "eval": 0.9,
+    "exec": 0.9,
+    "os.system": 0.95,
+    "pickle.loads": 0.85,
+    "yaml.load": 0.8,
+}
+SHELL_CALL_RISK = 0.9  # subprocess.* called with shell=True
+
+
+def call_name(func: ast.expr) -> str:
+    """Dotted name of a call target, e.g. "os.system"; empty for computed callees"""
+    parts = []
+    while isinstance(func, ast.Attribute):
+        parts.append(func.attr)
+        func = func.value
+    if isinstance(func, ast.Name):
+        parts.append(func.id)
+        return ".".join(reversed(parts))
+    return ""
+
+
+def call_risk(node: ast.Call, name: str) -> Optional[float]:
+    """Risk weight of a call site named name, or None when no rule matches"""
+    risk = RISKY_CALLS.get(name)
+    if risk is None and name.startswith("subprocess.") and any(
+        kw.arg == "shell" and isinstance(kw.value, ast.Constant) and kw.value.value is True
+        for kw in node.keywords
+    ):
+        risk = SHELL_CALL_RISK
+    return risk
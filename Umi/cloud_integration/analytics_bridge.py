@@ -1,6 +1,7 @@
 import ssl
 import socket
-import json
+import io
+import orjson
 from telemetry_db import TelemetryDB
 from cryptography.hazmat.primitives import serialization
 from queue import Queue
@@ -8,11 +9,18 @@ import threading
 import time
 import logging
 import os
-import zlib
-from typing import Dict, Any, List, Tuple
+import struct
+import google_crc32c
+import zstandard as zstd
+from typing import Dict, Any, List, Optional, Tuple
 
 logging.basicConfig(filename='analytics_bridge.log', level=logging.INFO)
 
+# 1.2 uploaded a hex JSON envelope of a zlib-compressed JSON array with CRC32.
+# 2.0 uploads a binary <II frame (CRC32C, length) around a zstd-compressed NDJSON stream.
+SCHEMA_VERSION = 2.0
+WIRE_FORMAT = {"algo": "zstd", "checksum": "crc32c", "encoding": "ndjson", "framing": "crc32c-len-le"}
+
 class AnalyticsBridge:
     def __init__(self, telemetry_db: TelemetryDB, cloud_host: str, port: int = 443):
         self.db = telemetry_db
@@ -24,6 +32,12 @@ class AnalyticsBridge:
         self.client_cert = self._load_file('client_cert.pem')
         self.client_key = self._load_file('client_key.pem')
         self.ca_cert = self._load_file('ca_cert.pem')
+        self._cctx = zstd.ZstdCompressor(level=3)
+        # Built once: cert parsing and cipher setup are too costly to repeat per sync
+        self._ssl_ctx = self._create_secure_context()
+        # Long-lived connection reused across syncs; reopened (with session resumption) on error
+        self._ssock: Optional[ssl.SSLSocket] = None
+        self._last_session: Optional[ssl.SSLSession] = None
 
     def _load_file(self, path: str) -> str:
         """Load PEM file or return empty string"""
@@ -46,32 +60,74 @@ class AnalyticsBridge:
         context.verify_mode = ssl.CERT_REQUIRED
         return context
 
+    def _connect(self) -> ssl.SSLSocket:
+        """Return the persistent TLS socket, reconnecting if it was dropped"""
+        if self._ssock is None:
+            sock = socket.create_connection((self.host, self.port), timeout=10)
+            try:
+                self._ssock = self._ssl_ctx.wrap_socket(
+                    sock, server_hostname=self.host, session=self._last_session
+                )
+            except Exception:
+                sock.close()
+                raise
+        return self._ssock
+
+    def _close_connection(self):
+        """Drop the persistent TLS socket so the next sync reconnects"""
+        if self._ssock is not None:
+            try:
+                self._ssock.close()
+            except OSError:
+                pass
+            self._ssock = None
+
     def sync_telemetry(self, force_full: bool = False):
         """Synchronize telemetry with cloud endpoint"""
         with self.lock:  # ensure single sync at a time
-            try:
-                with socket.create_connection((self.host, self.port), timeout=10) as sock:
-                    with self._create_secure_context().wrap_socket(sock, server_hostname=self.host) as ssock:
-                        payload = {
-                            "last_sync": self.db.get_last_sync_timestamp(),
-                            "schema_version": 1.2
-                        }
-                        ssock.sendall(json.dumps(payload).encode())
-                        raw = ssock.recv(4096)
-                        response = json.loads(raw.decode())
-
-                        if response.get("delta_available") and not force_full:
-                            self._send_delta(ssock, response["since"])
-                        else:
-                            self._send_full(ssock)
-            except (ssl.SSLError, ConnectionError, TimeoutError, OSError) as e:
-                logging.error(f"Sync failed: {e}, queuing for retry")
+            for attempt in range(2):
+                reused = self._ssock is not None
                 try:
-                    self.offline_queue.put_nowait(
-                        ("delta" if not force_full else "full", time.time())
-                    )
-                except:
-                    logging.warning("Offline queue full, dropping telemetry")
+                    self._sync_once(self._connect(), force_full)
+                    return
+                except (ssl.SSLError, ConnectionError, TimeoutError, OSError) as e:
+                    self._close_connection()
+                    if reused and attempt == 0:
+                        # The server likely closed the idle keep-alive; retry once on a fresh connection
+                        logging.info(f"Reused connection failed: {e}, reconnecting")
+                        continue
+                    logging.error(f"Sync failed: {e}, queuing for retry")
+                    try:
+                        self.offline_queue.put_nowait(
+                            ("delta" if not force_full else "full", time.time())
+                        )
+                    except:
+                        logging.warning("Offline queue full, dropping telemetry")
+                    return
+                except Exception:
+                    # Protocol state is unknown after a partial exchange; never reuse that socket
+                    self._close_connection()
+                    raise
+
+    def _sync_once(self, ssock: ssl.SSLSocket, force_full: bool):
+        """Run one handshake-and-upload exchange over an open connection"""
+        payload = {
+            "last_sync": self.db.get_last_sync_timestamp(),
+            "schema_version": SCHEMA_VERSION,
+            **WIRE_FORMAT
+        }
+        ssock.sendall(orjson.dumps(payload))
+        raw = ssock.recv(4096)
+        if not raw:
+            raise ConnectionError("Connection closed by peer")
+        response = orjson.loads(raw)
+        # TLS 1.3 tickets arrive after the handshake, so capture the session once data has flowed
+        self._last_session = ssock.session
+
+        if response.get("delta_available") and not force_full:
+            self._send_delta(ssock, response["since"])
+        else:
+            self._send_full(ssock)
 
     def _send_delta(self, ssock: ssl.SSLSocket, since: float):
         records = self.db.get_telemetry_since(since)
@@ -82,17 +138,22 @@ class AnalyticsBridge:
         ssock.sendall(self._compress_records(records))
 
     def _compress_records(self, records: List[Dict[str, Any]]) -> bytes:
-        """Apply JSON serialization + zlib compression with checksum"""
-        raw = json.dumps(records).encode()
-        compressed = zlib.compress(raw, level=9)
-        checksum = zlib.crc32(raw)
-        package = {
-            "compressed": True,
-            "algo": "zlib",
-            "checksum": checksum,
-            "payload": compressed.hex()
-        }
-        return json.dumps(package).encode()
+        """Stream records as newline-delimited JSON through zstd with checksum
+
+        Records are serialized one at a time straight into the compressor, so the
+        uncompressed payload is never held in memory as a whole. Frame layout:
+        little-endian u32 CRC32C of the uncompressed NDJSON, u32 compressed
+        length, then the zstd frame itself.
+        """
+        buf = io.BytesIO()
+        checksum = 0
+        with self._cctx.stream_writer(buf, closefd=False) as writer:
+            for record in records:
+                line = orjson.dumps(record) + b"\n"
+                checksum = google_crc32c.extend(checksum, line)  # hardware CRC32C where available
+                writer.write(line)
+        compressed = buf.getvalue()
+        return struct.pack("<II", checksum, len(compressed)) + compressed
 
     def start_background_sync(self, interval: int = 300):
         def worker():
@@ -103,6 +164,8 @@ class AnalyticsBridge:
 
     def stop_background_sync(self):
         self.stop_event.set()
+        with self.lock:
+            self._close_connection()
 
 
 # Example usage
@@ -2,87 +2,287 @@ import torch
 import numpy as np
 from telemetry_db import TelemetryDB
 from refactor_optimizer import RefactorEngine
-import docker
+import aiohttp
+import asyncio
+import re
+import struct
 import time
 import logging
-from collections import deque
 import os
 import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional, Tuple
 
 logging.basicConfig(filename='trainer.log', level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
+DOCKER_SOCKET = "/var/run/docker.sock"
+DOCKER_API = "/v1.43"
+# No total deadline: the logs request stays open for the whole training run
+DOCKER_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=30)
+TRAINING_IMAGE = "pytorch/training:latest"
+PREFETCH_LEAD = 60.0        # seconds before a periodic cycle that its batch is sampled
+PREFETCH_MAX_AGE = 300.0    # prefetched batches older than this are re-sampled
+SHM_DIR = "/dev/shm"  # RAM-backed on Linux hosts; batch hand-off files never touch disk
+ACC_RE = re.compile(rb"Validation accuracy: ([0-9.]+)")
+# Non-TTY log frames: stream type (1 stdout, 2 stderr), 3 zero bytes, big-endian u32 payload length
+LOG_FRAME_HEADER = struct.Struct(">B3xL")
+RAW_STREAM_TYPE = "application/vnd.docker.raw-stream"
+
+
+def demux_log_frames(buf: bytes) -> Tuple[List[Tuple[int, bytes]], bytes]:
+    """Split multiplexed container logs into (stream type, payload) frames plus any trailing partial frame"""
+    frames = []
+    pos = 0
+    while len(buf) - pos >= LOG_FRAME_HEADER.size:
+        stream, size = LOG_FRAME_HEADER.unpack_from(buf, pos)
+        end = pos + LOG_FRAME_HEADER.size + size
+        if end > len(buf):
+            break
+        frames.append((stream, buf[pos + LOG_FRAME_HEADER.size:end]))
+        pos = end
+    return frames, buf[pos:]
+
+
+def quantize_emb(x: np.ndarray):
+    """Symmetric per-row int8 quantization; returns (int8 rows, float32 per-row scale)"""
+    scale = (np.abs(x).max(axis=1) / 127.0).astype(np.float32)
+    safe = np.where(scale == 0, np.float32(1), scale)
+    q = np.clip(np.round(x / safe[:, None]), -127, 127).astype(np.int8)
+    return q, scale
+
 
 class FeedbackTrainer:
     def __init__(self, telemetry_db: TelemetryDB, refactor_engine: RefactorEngine,
                  replay_size: int = 10000, exploration_rate: float = 0.15):
         self.db = telemetry_db
         self.engine = refactor_engine
-        self.client = docker.from_env()
-        self.replay_buffer = deque(maxlen=replay_size)
+        # One event loop and one keep-alive Docker Engine API session shared by create/start/logs/remove
+        self._loop = asyncio.new_event_loop()
+        self._docker = None
+        # Replay buffer as a struct-of-tensors ring kept on the training device (VRAM when present).
+        # Embeddings are stored int8 with a per-row scale (4x the rows of FP32 in the same memory);
+        # that storage is allocated on first insert once the dimension is known
+        self.replay_size = replay_size
+        self._buf_device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        # CUDA availability is probed once; training containers reuse the answer
+        self._nvidia_runtime = "nvidia" if self._buf_device.type == "cuda" else None
+        self._batch_dir = SHM_DIR if os.path.isdir(SHM_DIR) else "."
+        self._emb_q = None                                        # (replay_size, D) int8
+        self._emb_scale = torch.zeros(replay_size, dtype=torch.float32, device=self._buf_device)
+        self._labels = torch.zeros(replay_size, dtype=torch.int8, device=self._buf_device)
+        self._weights = torch.zeros(replay_size, dtype=torch.float32, device=self._buf_device)
+        self._write_idx = 0
+        self._size = 0
         self.model_version = 1.0
         self.exploration_rate = exploration_rate
         self.lock = threading.Lock()  # Thread safety for version updates
+        # Next cycle's batch is sampled on this thread shortly before the cycle starts
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="batch-prefetch")
+        self._next_batch_future: Optional[Future] = None
+        self._next_batch_at = 0.0
+
+    def _fetch_contexts(self, suggestion_ids: list) -> list:
+        """Look up suggestion contexts in one call when the engine supports it"""
+        with self.lock:  # load_model swaps engine state under the same lock
+            bulk = getattr(self.engine, "get_suggestion_contexts_bulk", None)
+            if bulk is not None:
+                return bulk(suggestion_ids)
+            return [self.engine.get_suggestion_context(sid) for sid in suggestion_ids]
+
+    def _store_samples(self, emb: np.ndarray, labels: np.ndarray, weights: np.ndarray):
+        """Copy new rows into the replay ring on the buffer device, overwriting the oldest when full"""
+        n = len(labels)
+        if n == 0:
+            return
+        if n > self.replay_size:
+            emb, labels, weights = emb[-self.replay_size:], labels[-self.replay_size:], weights[-self.replay_size:]
+            n = self.replay_size
+        emb_q, emb_scale = quantize_emb(emb)
+        emb_q, emb_scale, labels, weights = (
+            torch.from_numpy(a).to(self._buf_device) for a in (emb_q, emb_scale, labels, weights)
+        )
+        if self._emb_q is None:
+            self._emb_q = torch.zeros((self.replay_size, emb_q.shape[1]), dtype=torch.int8, device=self._buf_device)
+
+        start = self._write_idx
+        first = min(n, self.replay_size - start)
+        for buf, rows in ((self._emb_q, emb_q), (self._emb_scale, emb_scale),
+                          (self._labels, labels), (self._weights, weights)):
+            buf[start:start + first] = rows[:first]
+            buf[:n - first] = rows[first:]
+        self._write_idx = (start + n) % self.replay_size
+        self._size = min(self._size + n, self.replay_size)
 
     def _sample_training_batch(self, batch_size: int = 32):
-        """Create training samples from telemetry with acceptance/rejection labels"""
+        """Create training samples from telemetry with acceptance/rejection labels
+
+        Returns (embeddings, labels, weights) tensors, or None when the replay buffer is empty.
+        """
         adaptation_data = self.db.get_adaptation_data()
-        samples = []
-
-        for suggestion_id, acceptance_ratio in adaptation_data.items():
-            context = self.engine.get_suggestion_context(suggestion_id)
-            if context:
-                samples.append({
-                    'input': context['embedding'],
-                    'label': 1 if acceptance_ratio > 0.5 else 0,
-                    'weight': abs(acceptance_ratio - 0.5) * 2
-                })
-        
+        suggestion_ids = list(adaptation_data)
+        ratios = np.fromiter(adaptation_data.values(), dtype=np.float32, count=len(suggestion_ids))
+        contexts = self._fetch_contexts(suggestion_ids)
+        mask = np.fromiter((bool(c) for c in contexts), dtype=bool, count=len(contexts))
+
         # Store in replay buffer
-        self.replay_buffer.extend(samples)
-
-        # Sample batch from replay buffer
-        return list(np.random.choice(list(self.replay_buffer), min(batch_size, len(self.replay_buffer))))
-
-    def _update_model(self, model_path: str):
-        """Launch isolated training container with mounted model volume"""
-        container = self.client.containers.run(
-            "pytorch/training:latest",
-            command=f"python train.py --input /data/model.pt --version {self.model_version}",
-            volumes={os.path.abspath(model_path): {'bind': '/data/model.pt', 'mode': 'rw'}},
-            detach=True,
-            runtime="nvidia" if torch.cuda.is_available() else None
-        )
-        return container
+        if mask.any():
+            kept = ratios[mask]
+            self._store_samples(
+                np.stack([np.asarray(c['embedding'], dtype=np.float32).reshape(-1) for c in contexts if c]),
+                (kept > 0.5).astype(np.int8),
+                np.abs(kept - 0.5) * 2.0
+            )
 
-    def _validate_model(self, container):
+        if self._size == 0:
+            return None
+        # Sample batch from replay buffer on its own device (with replacement, like np.random.choice)
+        idx = torch.randint(0, self._size, (min(batch_size, self._size),), device=self._buf_device)
+        # Dequantize only the sampled rows
+        emb = self._emb_q.index_select(0, idx).float() * self._emb_scale.index_select(0, idx).unsqueeze(1)
+        return emb, self._labels.index_select(0, idx), self._weights.index_select(0, idx)
+
+    async def _docker_session(self) -> aiohttp.ClientSession:
+        """Persistent HTTP session over the Docker unix socket, created on the trainer loop"""
+        if self._docker is None or self._docker.closed:
+            self._docker = aiohttp.ClientSession(
+                connector=aiohttp.UnixConnector(path=DOCKER_SOCKET),
+                base_url="http://docker",
+                timeout=DOCKER_TIMEOUT
+            )
+        return self._docker
+
+    async def _update_model(self, model_path: str, batch_path: str) -> str:
+        """Launch isolated training container with mounted model and batch volumes, returning its id"""
+        docker = await self._docker_session()
+        host_config = {"Binds": [
+            f"{os.path.abspath(model_path)}:/data/model.pt:rw",
+            f"{os.path.abspath(batch_path)}:/data/batch.pt:ro"
+        ]}
+        if self._nvidia_runtime:
+            host_config["Runtime"] = self._nvidia_runtime
+        body = {
+            "Image": TRAINING_IMAGE,
+            "Cmd": ["python", "train.py", "--input", "/data/model.pt", "--batch", "/data/batch.pt",
+                    "--version", str(self.model_version)],
+            "HostConfig": host_config
+        }
+        container_id = await self._create_container(body)
+        if container_id is None:
+            # Image not present locally; pull it like docker-py's containers.run did, then retry once
+            await self._pull_image(TRAINING_IMAGE)
+            container_id = await self._create_container(body)
+            if container_id is None:
+                raise RuntimeError(f"Image {TRAINING_IMAGE} unavailable after pull")
+        try:
+            async with docker.post(f"{DOCKER_API}/containers/{container_id}/start") as resp:
+                resp.raise_for_status()
+        except Exception:
+            await self._remove_container(container_id)
+            raise
+        return container_id
+
+    async def _create_container(self, body: dict) -> Optional[str]:
+        """Create a container and return its id, or None when the image is missing locally"""
+        docker = await self._docker_session()
+        async with docker.post(f"{DOCKER_API}/containers/create", json=body) as resp:
+            if resp.status == 404:
+                return None
+            resp.raise_for_status()
+            return (await resp.json())["Id"]
+
+    async def _pull_image(self, image: str):
+        """Pull an image through the Engine API, waiting for the progress stream to finish"""
+        docker = await self._docker_session()
+        name, _, tag = image.rpartition(":")
+        logging.info(f"Pulling training image {image}")
+        async with docker.post(f"{DOCKER_API}/images/create",
+                               params={"fromImage": name, "tag": tag}) as resp:
+            resp.raise_for_status()
+            async for _ in resp.content.iter_any():
+                pass  # progress messages; the pull is complete when the stream ends
+
+    async def _remove_container(self, container_id: str):
+        docker = await self._docker_session()
+        async with docker.delete(f"{DOCKER_API}/containers/{container_id}", params={"force": "1"}) as resp:
+            resp.raise_for_status()
+
+    def _accuracy_ok(self, line: bytes) -> bool:
+        """False when the log line reports a validation accuracy below threshold"""
+        match = ACC_RE.search(line)
+        if match:
+            acc = float(match.group(1).decode())
+            if acc < 0.7:
+                logging.warning(f"Model accuracy {acc} below threshold, rolling back")
+                return False
+        return True
+
+    async def _stream_validation(self, container_id: str) -> bool:
+        """Follow container logs over the Docker Engine API and check each accuracy report"""
+        docker = await self._docker_session()
+        async with docker.get(
+            f"{DOCKER_API}/containers/{container_id}/logs",
+            params={"follow": "1", "stdout": "1", "stderr": "1"}
+        ) as resp:
+            resp.raise_for_status()
+            # Training containers run without a TTY, so logs arrive as multiplexed frames
+            multiplexed = resp.content_type != RAW_STREAM_TYPE
+            pending = b""  # partial frame left over from the previous chunk
+            carry = {}     # stream type -> partial line
+            async for chunk in resp.content.iter_any():
+                if multiplexed:
+                    frames, pending = demux_log_frames(pending + chunk)
+                else:
+                    frames = [(1, chunk)]
+                for stream, payload in frames:
+                    *lines, carry[stream] = (carry.get(stream, b"") + payload).split(b"\n")
+                    for line in lines:
+                        logging.debug("training: %s", line)
+                        if not self._accuracy_ok(line):
+                            return False
+            return all(self._accuracy_ok(line) for line in carry.values())
+
+    async def _validate_model(self, container_id: str) -> bool:
         """Monitor training and validate new model performance"""
         try:
-            for line in container.logs(stream=True):
-                decoded = line.decode().strip()
-                logging.info(decoded)
-                if "Validation accuracy" in decoded:
-                    acc = float(decoded.split(": ")[1])
-                    if acc < 0.7:
-                        logging.warning(f"Model accuracy {acc} below threshold, rolling back")
-                        return False
-            return True
+            return await self._stream_validation(container_id)
         finally:
-            container.remove(force=True)  # Ensure container cleanup
+            await self._remove_container(container_id)  # Ensure container cleanup
+
+    def prefetch_next_batch(self):
+        """Start sampling the next cycle's batch in the background"""
+        if self._next_batch_future is None:
+            self._next_batch_at = time.monotonic()
+            self._next_batch_future = self._executor.submit(self._sample_training_batch)
 
     def run_training_cycle(self):
         """Execute full training pipeline with safety checks"""
         try:
-            training_data = self._sample_training_batch()
-            if not training_data:
+            training_data = None
+            if self._next_batch_future is not None:
+                future, self._next_batch_future = self._next_batch_future, None
+                training_data = future.result()
+                if time.monotonic() - self._next_batch_at > PREFETCH_MAX_AGE:
+                    training_data = None  # telemetry has moved on; sample afresh
+            if training_data is None:
+                training_data = self._sample_training_batch()
+            if training_data is None:
                 logging.info("No sufficient data for training")
                 return
 
             model_file = f"model_v{self.model_version:.1f}.pt"
-            torch.save(training_data, f"training_batch_v{self.model_version:.1f}.pt")
-            container = self._update_model(model_file)
+            batch_file = os.path.join(self._batch_dir, f"training_batch_v{self.model_version:.1f}.pt")
+            # Plain tensors in a zipfile checkpoint: the container loads them without unpickling Python objects
+            emb, labels, weights = (t.cpu().contiguous() for t in training_data)
+            torch.save({'emb': emb, 'labels': labels, 'weights': weights}, batch_file,
+                       _use_new_zipfile_serialization=True)
+            try:
+                container_id = self._loop.run_until_complete(self._update_model(model_file, batch_file))
+                validated = self._loop.run_until_complete(self._validate_model(container_id))
+            finally:
+                os.remove(batch_file)  # container is gone by now; free the shared-memory copy
 
-            if self._validate_model(container):
+            if validated:
                 with self.lock:
                     self.engine.load_model(model_file)
                     logging.info(f"Model promoted to v{self.model_version:.1f}")
@@ -91,17 +291,27 @@ class FeedbackTrainer:
                 os.remove(model_file)
                 logging.warning(f"Discarded model {model_file} due to validation failure")
 
-        except docker.errors.DockerException as e:
-            logging.error(f"Docker container failed: {e}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error(f"Docker container failed: {e!r}")
         except Exception as e:
             logging.critical(f"Training cycle aborted: {e}")
 
+    def close(self):
+        """Stop batch prefetching and close the Docker API session and the trainer event loop"""
+        self._executor.shutdown(wait=True)
+        if self._docker is not None:
+            self._loop.run_until_complete(self._docker.close())
+        self._loop.close()
+
     def start_periodic_training(self, interval_hours: float = 12):
         """Start periodic training in a separate thread"""
         def periodic():
+            interval = interval_hours * 3600
             while True:
                 self.run_training_cycle()
-                time.sleep(interval_hours * 3600)
+                time.sleep(max(interval - PREFETCH_LEAD, 0))
+                self.prefetch_next_batch()
+                time.sleep(min(PREFETCH_LEAD, interval))
 
         thread = threading.Thread(target=periodic, daemon=True)
         thread.start()
@@ -3,9 +3,12 @@ from refactor_optimizer import RefactorEngine
 from style_adapter import StyleAdapter
 from telemetry_db import TelemetryDB
 import threading
+import collections
 import queue
+import atexit
 import time
 import logging
+from logging.handlers import QueueHandler, QueueListener
 from enum import Enum
 from typing import Optional, Dict, Any, List
 
@@ -15,108 +18,199 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+_log_lock = threading.Lock()
+_log_listener: Optional[QueueListener] = None
+_log_saved_handlers: List[logging.Handler] = []
+_log_users = 0
+
+
+def configure_logging():
+    """Move the root handlers behind a queue so workers only enqueue records
+
+    One listener thread does the formatting and file I/O. Reference counted across
+    running pipelines; undone by release_logging.
+    """
+    global _log_listener, _log_saved_handlers, _log_users
+    with _log_lock:
+        _log_users += 1
+        if _log_listener is not None:
+            return
+        root = logging.getLogger()
+        log_queue: queue.SimpleQueue = queue.SimpleQueue()
+        _log_saved_handlers = root.handlers[:]
+        _log_listener = QueueListener(log_queue, *_log_saved_handlers, respect_handler_level=True)
+        root.handlers = [QueueHandler(log_queue)]
+        _log_listener.start()
+
+
+def release_logging(force: bool = False):
+    """Drain the log queue and restore the original root handlers once no pipeline needs it"""
+    global _log_listener, _log_users
+    with _log_lock:
+        _log_users = 0 if force else max(_log_users - 1, 0)
+        if _log_listener is None or _log_users:
+            return
+        _log_listener.stop()
+        logging.getLogger().handlers = _log_saved_handlers
+        _log_listener = None
+
+
+atexit.register(release_logging, force=True)  # flush queued records if shutdown() was never called
+
 class PipelineStage(Enum):
-    CONTEXT_ANALYSIS = 1
-    VULNERABILITY_SCAN = 2
-    OPTIMIZATION_GEN = 3
-    STYLE_ADAPTATION = 4
-    TELEMETRY_HOOK = 5
+    CONTEXT_ANALYSIS = 1  # fused context analysis + vulnerability scan
+    OPTIMIZATION_GEN = 2
+    STYLE_ADAPTATION = 3
+    TELEMETRY_HOOK = 4
+
+class Task:
+    """Pipeline work item; __slots__ keeps it compact and makes field access a slot load, not a dict lookup"""
+    __slots__ = ('stage', 'file_path', 'code', 'code_hash', 'metadata', 'attempts', 'priority',
+                 'context_report', 'vuln_report', 'optimizations', 'final_suggestions')
+
+    def __init__(self, stage: PipelineStage, file_path: str, code: str,
+                 metadata: Optional[Dict[str, Any]] = None, priority: int = 5,
+                 code_hash: str = ""):
+        self.stage = stage
+        self.file_path = file_path
+        self.code = code
+        self.code_hash = code_hash
+        self.metadata = metadata if metadata is not None else {}
+        self.attempts = 0
+        self.priority = priority
+        self.context_report: Optional[Dict[str, Any]] = None
+        self.vuln_report: Optional[List[Dict[str, Any]]] = None
+        self.optimizations: Optional[List[Dict[str, Any]]] = None
+        self.final_suggestions: Optional[List[Dict[str, Any]]] = None
 
 class SuggestionPipeline:
-    def __init__(self, telemetry_db: TelemetryDB, max_queue_size: int = 100):
+    def __init__(self, telemetry_db: TelemetryDB, max_queue_size: int = 100, max_results: int = 1000):
         self.db = telemetry_db
         self.context_analyzer = ContextAnalyzer()
         self.refactor_engine = RefactorEngine()
         self.style_adapter = StyleAdapter(telemetry_db)
-        self.task_queue: queue.PriorityQueue = queue.PriorityQueue(maxsize=max_queue_size)
+        # One deque per stage; append/popleft are atomic, so stage hand-offs take no queue lock
+        self._stage_queues: Dict[PipelineStage, collections.deque] = {
+            stage: collections.deque() for stage in PipelineStage
+        }
+        self._drain_order = list(reversed(PipelineStage))  # downstream first keeps the pipeline shallow
+        self._cv = threading.Condition()  # idle workers wait here for new work
+        self._slots = threading.BoundedSemaphore(max_queue_size)  # caps tasks in flight
         self.worker_threads: List[threading.Thread] = []
         self.stop_event = threading.Event()
-        self.results: List[Dict[str, Any]] = []
+        self._handlers = {
+            PipelineStage.CONTEXT_ANALYSIS: self._stage_context,
+            PipelineStage.OPTIMIZATION_GEN: self._stage_optimize,
+            PipelineStage.STYLE_ADAPTATION: self._stage_style,
+            PipelineStage.TELEMETRY_HOOK: self._stage_telemetry,
+        }
+        # Most recent completed tasks only; older ones are dropped once telemetry has recorded them
+        self.results: collections.deque = collections.deque(maxlen=max_results)
 
     def ingest_code_context(self, file_path: str, code: str, priority: int = 5):
-        """Queue code processing task with configurable priority"""
-        task = {
-            'stage': PipelineStage.CONTEXT_ANALYSIS,
-            'file_path': file_path,
-            'code': code,
-            'metadata': {},
-            'attempts': 0
-        }
+        """Queue code processing task; priority below the default of 5 jumps the entry queue"""
+        task = Task(PipelineStage.CONTEXT_ANALYSIS, file_path, code, priority=priority,
+                    code_hash=ContextAnalyzer.code_hash(code))
         logging.info(f"Ingesting code for file {file_path} with priority {priority}")
-        self.task_queue.put((priority, task))
+        self._slots.acquire()  # blocks while max_queue_size tasks are in flight
+        self._enqueue(task, front=priority < 5)
+
+    def _enqueue(self, task: Task, front: bool = False):
+        stage_queue = self._stage_queues[task.stage]
+        if front:
+            stage_queue.appendleft(task)
+        else:
+            stage_queue.append(task)
+        with self._cv:
+            self._cv.notify()
+
+    def _next_task(self) -> Optional[Task]:
+        for stage in self._drain_order:
+            try:
+                return self._stage_queues[stage].popleft()
+            except IndexError:
+                continue
+        return None
 
     def _worker_loop(self):
         while not self.stop_event.is_set():
+            # Block on the condition until work arrives; _enqueue and shutdown() notify it
+            with self._cv:
+                task = self._next_task()
+                while task is None and not self.stop_event.is_set():
+                    self._cv.wait()
+                    task = self._next_task()
+            if task is None:
+                continue
             try:
-                priority, task = self.task_queue.get(timeout=1)
                 self._process_task(task)
-            except queue.Empty:
-                continue
             except Exception as e:
                 logging.error(f"Worker encountered unexpected error: {e}")
 
-    def _process_task(self, task: dict):
+    def _stage_context(self, task: Task) -> Optional[PipelineStage]:
+        task.context_report, task.vuln_report = self.context_analyzer.analyze_cached(
+            task.code_hash, task.code
+        )
+        return PipelineStage.OPTIMIZATION_GEN
+
+    def _stage_optimize(self, task: Task) -> Optional[PipelineStage]:
+        task.optimizations = self.refactor_engine.generate_optimizations(
+            task.code,
+            task.context_report,
+            vuln_report=task.vuln_report
+        )
+        return PipelineStage.STYLE_ADAPTATION
+
+    def _stage_style(self, task: Task) -> Optional[PipelineStage]:
+        adapted = self.style_adapter.adapt_code_snippets(
+            [opt['suggested_code'] for opt in task.optimizations]
+        )
+        task.final_suggestions = [
+            {**opt, 'adapted_code': code} for opt, code in zip(task.optimizations, adapted)
+        ]
+        return PipelineStage.TELEMETRY_HOOK
+
+    def _stage_telemetry(self, task: Task) -> Optional[PipelineStage]:
+        self.db.record_interactions([
+            {
+                'event_type': 'GENERATED',
+                'suggestion_id': suggestion['id'],
+                'context_embedding': suggestion.get('context_embedding', b'')
+            }
+            for suggestion in task.final_suggestions
+        ])
+        logging.info(f"Task for {task.file_path} completed successfully")
+        self.results.append(task)
+        self._slots.release()
+        return None  # Terminal stage
+
+    def _process_task(self, task: Task):
         """Process a task through the pipeline stages"""
         try:
-            task['attempts'] += 1
-            stage = task['stage']
-
-            if stage == PipelineStage.CONTEXT_ANALYSIS:
-                task['context_report'] = self.context_analyzer.analyze(task['code'])
-                task['stage'] = PipelineStage.VULNERABILITY_SCAN
-
-            elif stage == PipelineStage.VULNERABILITY_SCAN:
-                task['vuln_report'] = self.context_analyzer.scan_vulnerabilities(
-                    task['code'],
-                    task['context_report']
-                )
-                task['stage'] = PipelineStage.OPTIMIZATION_GEN
-
-            elif stage == PipelineStage.OPTIMIZATION_GEN:
-                task['optimizations'] = self.refactor_engine.generate_optimizations(
-                    task['code'],
-                    task['context_report'],
-                    vuln_report=task.get('vuln_report')
-                )
-                task['stage'] = PipelineStage.STYLE_ADAPTATION
-
-            elif stage == PipelineStage.STYLE_ADAPTATION:
-                adapted_optimizations = []
-                for opt in task['optimizations']:
-                    adapted_code = self.style_adapter.adapt_code_snippet(opt['suggested_code'])
-                    adapted_optimizations.append({**opt, 'adapted_code': adapted_code})
-                task['final_suggestions'] = adapted_optimizations
-                task['stage'] = PipelineStage.TELEMETRY_HOOK
-
-            elif stage == PipelineStage.TELEMETRY_HOOK:
-                for suggestion in task['final_suggestions']:
-                    self.db.record_interaction(
-                        event_type='GENERATED',
-                        suggestion_id=suggestion['id'],
-                        context_embedding=suggestion.get('context_embedding', b'')
-                    )
-                logging.info(f"Task for {task['file_path']} completed successfully")
-                self.results.append(task)
-                return  # Terminal stage
-
-            # Requeue for next stage with slightly higher priority to avoid starvation
-            self.task_queue.put((max(0, task.get('priority', 5) - 1), task))
+            task.attempts += 1
+            next_stage = self._handlers[task.stage](task)
+            if next_stage is not None:
+                task.stage = next_stage
+                self._enqueue(task)  # hand off to the next stage's queue
 
         except Exception as e:
-            logging.error(f"Pipeline stage {task['stage']} failed: {e}")
-            if task['attempts'] < 3:
-                logging.info(f"Retrying task {task.get('file_path')}, attempt {task['attempts']}")
-                self.task_queue.put((task.get('priority', 5), task))
+            logging.error(f"Pipeline stage {task.stage} failed: {e}")
+            if task.attempts < 3:
+                logging.info(f"Retrying task {task.file_path}, attempt {task.attempts}")
+                self._enqueue(task)
             else:
+                self._slots.release()
                 self.db.record_interaction(
                     event_type='PIPELINE_ERROR',
-                    suggestion_id=f"ERR_{task['stage'].name}",
+                    suggestion_id=f"ERR_{task.stage.name}",
                     context_embedding=b''
                 )
-                logging.error(f"Task failed after 3 attempts: {task.get('file_path')}")
+                logging.error(f"Task failed after 3 attempts: {task.file_path}")
 
     def start_workers(self, num_workers: int = 4):
         """Launch parallel processing threads"""
+        if not self.worker_threads:
+            configure_logging()
         for _ in range(num_workers):
             thread = threading.Thread(target=self._worker_loop, daemon=True)
             thread.start()
@@ -127,9 +221,14 @@ class SuggestionPipeline:
         """Gracefully shutdown the pipeline"""
         logging.info("Shutting down pipeline...")
         self.stop_event.set()
+        with self._cv:
+            self._cv.notify_all()
         for thread in self.worker_threads:
             thread.join(timeout=5)
         logging.info("Pipeline shutdown complete")
+        if self.worker_threads:
+            self.worker_threads = []
+            release_logging()
 
 if __name__ == "__main__":
     db = TelemetryDB()